@@ -16,7 +16,13 @@ It is possible to split these stages or do everything at one go.
 
 import os
 import sys
+import socket
+import time
+import threading
 from io import StringIO
+import inspect
+import xml.parsers.expat as expat
+from urllib.parse import unquote_plus
 from minio import Minio
 from minio.deleteobjects import DeleteObject
 from contextlib import redirect_stdout
@@ -132,6 +138,22 @@ parser.add_argument(
     type=Optional[str],
     help="S3 Region",
 )
+parser.add_argument(
+    "--fastlist",
+    "--fast-list",
+    action="store_true",
+    dest="fastlist_flag",
+    default=False,
+    help="list objects with streaming ListObjectsV2 parser, only key, size and last modified are extracted",
+)
+parser.add_argument(
+    "--fastlistflag",
+    "--fast-list-flag",
+    type=bool,
+    dest="fastlist_flag",
+    default=False,
+    help="list objects with streaming ListObjectsV2 parser, only key, size and last modified are extracted",
+)
 parser.add_argument(
     "--s3diskname",
     "--s3-disk-name",
@@ -232,6 +254,112 @@ parser.add_argument(
     type=Optional[int],
     help="Number of already collected objects to process. Can be used in conjunction with use-after",
 )
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    dest="incremental_flag",
+    default=False,
+    help="collect only objects written or failed to be deleted since the last run according to system.blob_storage_log",
+)
+parser.add_argument(
+    "--incrementalflag",
+    "--incremental-flag",
+    type=bool,
+    dest="incremental_flag",
+    default=False,
+    help="collect only objects written or failed to be deleted since the last run according to system.blob_storage_log",
+)
+parser.add_argument(
+    "--incrementalsince",
+    "--incremental-since",
+    dest="incrementalsince",
+    type=Optional[str],
+    help="time to read system.blob_storage_log from if there is no watermark from previous runs. If not specified, the whole log is read",
+)
+parser.add_argument(
+    "--watermarktableprefix",
+    "--watermark-table-prefix",
+    dest="watermarktableprefix",
+    default="s3gc_watermark_for_",
+    help="prefix for table name to keep time system.blob_storage_log is processed up to (database is allowed, if not exists, specify --create-database)",
+)
+parser.add_argument(
+    "--worktableprefix",
+    "--work-table-prefix",
+    dest="worktableprefix",
+    default="s3gc_work_for_",
+    help="prefix for table name to keep key ranges claimed by workers (database is allowed, if not exists, specify --create-database)",
+)
+parser.add_argument(
+    "--workinit",
+    "--work-init",
+    action="store_true",
+    dest="workinit_flag",
+    default=False,
+    help="split keyspace into ranges and put them in work table for workers",
+)
+parser.add_argument(
+    "--workinitflag",
+    "--work-init-flag",
+    type=bool,
+    dest="workinit_flag",
+    default=False,
+    help="split keyspace into ranges and put them in work table for workers",
+)
+parser.add_argument(
+    "--worker",
+    action="store_true",
+    dest="worker_flag",
+    default=False,
+    help="claim key ranges from work table and process them until all ranges are done",
+)
+parser.add_argument(
+    "--workerflag",
+    "--worker-flag",
+    type=bool,
+    dest="worker_flag",
+    default=False,
+    help="claim key ranges from work table and process them until all ranges are done",
+)
+parser.add_argument(
+    "--workranges",
+    "--work-ranges",
+    dest="workranges",
+    type=int,
+    default=64,
+    help="number of key ranges to split keyspace into",
+)
+parser.add_argument(
+    "--workerid",
+    "--worker-id",
+    dest="workerid",
+    default="",
+    help="worker name in work table, hostname and pid by default",
+)
+parser.add_argument(
+    "--leaseseconds",
+    "--lease-seconds",
+    dest="leaseseconds",
+    type=int,
+    default=600,
+    help="time in seconds a claimed key range is leased to a worker, the lease is prolonged while worker is alive",
+)
+parser.add_argument(
+    "--worksummary",
+    "--work-summary",
+    action="store_true",
+    dest="worksummary_flag",
+    default=False,
+    help="print summary of work table",
+)
+parser.add_argument(
+    "--worksummaryflag",
+    "--work-summary-flag",
+    type=bool,
+    dest="worksummary_flag",
+    default=False,
+    help="print summary of work table",
+)
 parser.add_argument(
     "--dryrun",
     "--dry-run",
@@ -256,6 +384,21 @@ parser.add_argument(
     default="",
     help="Consider an objects unused if there is no host in the cluster refers the object",
 )
+parser.add_argument(
+    "--distributed",
+    action="store_true",
+    dest="distributed_flag",
+    default=False,
+    help="create auxiliary table as Distributed table over the cluster sharded by CRC32(objpath), antijoin is done on shards",
+)
+parser.add_argument(
+    "--distributedflag",
+    "--distributed-flag",
+    type=bool,
+    dest="distributed_flag",
+    default=False,
+    help="create auxiliary table as Distributed table over the cluster sharded by CRC32(objpath), antijoin is done on shards",
+)
 parser.add_argument(
     "--age",
     "--hours",
@@ -484,20 +627,58 @@ logger.addHandler(consoleHandler)
 
 logger.debug(f"Parameters: {args}")
 
-tname = ""
-dbname = None
 
-dbparts = args.collecttableprefix.split(".")
-if len(dbparts) > 2:
-    raise ValueError("invalid collecttableprefix")
-elif len(dbparts) == 2:
-    dbname = f"`{dbparts[0]}`"
-    tname = f"{dbname}.`{dbparts[1]}{args.s3diskname}`"
-else:
-    tname = f"`{dbparts[0]}{args.s3diskname}`"
+def make_table_name(prefix):
+    """Returns (database, table) names for a table prefix, database is None if not a part of the prefix"""
+    dbparts = prefix.split(".")
+    if len(dbparts) > 2:
+        raise ValueError(f"invalid table prefix {prefix}")
+    elif len(dbparts) == 2:
+        database = f"`{dbparts[0]}`"
+        return (database, f"{database}.`{dbparts[1]}{args.s3diskname}`")
+    return (None, f"`{dbparts[0]}{args.s3diskname}`")
+
+
+def quote_string(value):
+    return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
+
+
+(dbname, tname) = make_table_name(args.collecttableprefix)
+(workdbname, worktname) = make_table_name(args.worktableprefix)
+(watermarkdbname, watermarktname) = make_table_name(args.watermarktableprefix)
+worker_id = args.workerid or f"{socket.gethostname()}-{os.getpid()}"
+
+# with --distributed tname is a Distributed table over tname_local tables on the cluster,
+#   paths referenced in remote_data_paths are copied to refs_tname sharded the same way
+on_cluster = ""
+if args.distributed_flag:
+    if not args.clustername:
+        raise ValueError("cluster must be specified if distributed flag is set")
+    if args.worker_flag or args.workinit_flag:
+        raise ValueError("distributed flag is not supported for workers")
+    on_cluster = f" ON CLUSTER {quote_string(args.clustername)}"
+if args.incremental_flag:
+    if args.worker_flag or args.workinit_flag:
+        raise ValueError("incremental flag is not supported for workers")
+    if args.age == 0:
+        # blob_storage_log is flushed asynchronously, and blobs of running INSERTs and merges
+        #   are not in remote_data_paths yet
+        raise ValueError("age must be specified if incremental flag is set")
+    if args.useafter or args.usetotal or args.useage:
+        # candidates filtered out would be truncated and never read from the log again
+        raise ValueError("useafter, usetotal and useage are not supported with incremental flag")
+if args.worker_flag and args.interactive_flag and not (args.dryrun_flag or args.collectonly_flag):
+    raise ValueError("workers do not confirm deleting, specify --non-interactive or --dry-run")
+# rows are sharded by CRC32(objpath), partitions and samples must use an independent hash
+#   or each sample would be found on a part of shards only
+sample_hash = "xxHash32" if args.distributed_flag else "CRC32"
+tname_local = tname[:-1] + "_local`"
+refs_tname = tname[:-1] + "_refs`"
+refs_tname_local = tname[:-1] + "_refs_local`"
 
 minio_client = None
 ch_client = None
+current_lease = None
 
 
 def connect_to_ch():
@@ -505,12 +686,21 @@ def connect_to_ch():
         f"Connecting to ClickHouse, host={args.chhost}, port={args.chport}, username={args.chuser}, password={args.chpass}, s3path={args.s3path}, bucket={args.s3bucket}, s3path={args.s3path}"
     )
     global ch_client
-    ch_client = clickhouse_connect.get_client(
+    ch_client = make_ch_client()
+
+
+def make_ch_client():
+    settings = {}
+    if args.distributed_flag:
+        # inserted rows must be on shards before antijoin
+        settings["insert_distributed_sync"] = 1
+    return clickhouse_connect.get_client(
         host=args.chhost,
         port=args.chport,
         username=args.chuser,
         password=args.chpass,
         send_receive_timeout=args.chtimeout,
+        settings=settings,
     )
 
 
@@ -522,6 +712,10 @@ def connect_to_s3():
     logger.info(
         f"Connecting to S3, host:port={args.s3ip}:{args.s3port}, access_key={args.s3accesskey}, secret_key={args.s3secretkey}, secure={args.s3secure_flag}, region={args.s3region}"
     )
+    # TCP keep-alive on top of HTTP keep-alive, idle connections in the pool survive long ClickHouse inserts
+    socket_options = urllib3.connection.HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    ]
     global minio_client
     minio_client = Minio(
         f"{args.s3ip}:{args.s3port}",
@@ -529,51 +723,245 @@ def connect_to_s3():
         secret_key=args.s3secretkey,
         secure=args.s3secure_flag,
         region=args.s3region,
-        http_client=urllib3.PoolManager(cert_reqs="CERT_NONE"),
+        http_client=urllib3.PoolManager(
+            cert_reqs="CERT_NONE",
+            num_pools=1,
+            socket_options=socket_options,
+            retries=urllib3.Retry(
+                total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]
+            ),
+        ),
     )
 
 
-def do_collect():
-    logger.debug(f"start_after {args.collectafter}")
-    objects = minio_client.list_objects(
-        args.s3bucket, args.s3path, recursive=True, start_after=args.collectafter
-    )
+(LIST_KEY, LIST_SIZE, LIST_LAST_MODIFIED, LIST_IS_TRUNCATED, LIST_TOKEN, LIST_ENCODING) = range(6)
+list_fields = {
+    "Key": LIST_KEY,
+    "Size": LIST_SIZE,
+    "LastModified": LIST_LAST_MODIFIED,
+    "IsTruncated": LIST_IS_TRUNCATED,
+    "NextContinuationToken": LIST_TOKEN,
+    "EncodingType": LIST_ENCODING,
+}
 
+
+def fast_list_supported():
+    """list_objects_fast relies on private Minio._execute, its signature is checked"""
+    execute = getattr(minio_client, "_execute", None)
+    if execute is None:
+        return False
+    try:
+        params = inspect.signature(execute).parameters
+    except (TypeError, ValueError):
+        return False
+    return "query_params" in params and "preload_content" in params
+
+
+def list_objects_fast(bucket, prefix, start_after=None):
+    """
+    Generator of (object name, size, last modified) tuples.
+    Sends ListObjectsV2 requests via pooled minio_client connection and parses response
+      with expat while it is being received, no element objects are built.
+    Keys are url encoded by S3 like in minio list_objects, so any key is valid in XML.
+    """
+    query = {"list-type": "2", "max-keys": "1000", "prefix": prefix or "", "encoding-type": "url"}
+    if start_after:
+        query["start-after"] = start_after
+    utc = datetime.timezone.utc
+    fromisoformat = datetime.datetime.fromisoformat
+    get_field = list_fields.get
+
+    while True:
+        response = minio_client._execute(
+            "GET", bucket, query_params=query, preload_content=False
+        )
+        key = size = last_modified = None
+        is_truncated = False
+        token = None
+        url_encoded = False
+        text = []
+        # objects are written in the same seconds, conversion of LastModified is cached
+        last_modified_cache = {}
+        # EncodingType may follow Contents, objects are yielded when the page is parsed
+        page = []
+
+        # only text and end of elements are handled, text is collected until an element ends
+        def end_element(name):
+            nonlocal key, size, last_modified, is_truncated, token, url_encoded
+            field = get_field(name)
+            if field is None:
+                if name == "Contents":
+                    page.append((key, size, last_modified))
+            elif field == LIST_KEY:
+                key = "".join(text)
+            elif field == LIST_SIZE:
+                size = int("".join(text))
+            elif field == LIST_LAST_MODIFIED:
+                # e.g. 2024-06-12T10:20:30.000Z, fractional part is not needed
+                value = "".join(text)[:19]
+                last_modified = last_modified_cache.get(value)
+                if last_modified is None:
+                    last_modified = fromisoformat(value).replace(tzinfo=utc)
+                    last_modified_cache[value] = last_modified
+            elif field == LIST_IS_TRUNCATED:
+                is_truncated = "".join(text).lower() == "true"
+            elif field == LIST_TOKEN:
+                token = "".join(text)
+            elif field == LIST_ENCODING:
+                url_encoded = "".join(text) == "url"
+            text.clear()
+
+        xml_parser = expat.ParserCreate()
+        xml_parser.buffer_text = True
+        xml_parser.buffer_size = 65536
+        xml_parser.CharacterDataHandler = text.append
+        xml_parser.EndElementHandler = end_element
+        try:
+            for chunk in response.stream(65536):
+                xml_parser.Parse(chunk, False)
+            xml_parser.Parse(b"", True)
+        finally:
+            response.release_conn()
+
+        if url_encoded:
+            page = [
+                (unquote_plus(key), size, last_modified) if "%" in key or "+" in key else (key, size, last_modified)
+                for (key, size, last_modified) in page
+            ]
+            if key is not None:
+                key = unquote_plus(key)
+        yield from page
+
+        if not is_truncated or (not token and key is None):
+            break
+        if token:
+            query["continuation-token"] = token
+        else:
+            # some S3 compatible storages do not return NextContinuationToken
+            query.pop("continuation-token", None)
+            query["start-after"] = key
+
+
+def create_collect_table(drop=False):
     if args.createdatabase_flag:
-        parts = args.collecttableprefix.split(".")
         if dbname:
             logger.info(f"creating database {dbname}")
-            ch_client.command(f"CREATE DATABASE IF NOT EXISTS {dbname}")
+            ch_client.command(f"CREATE DATABASE IF NOT EXISTS {dbname}{on_cluster}")
             logger.debug(f"database created")
         else:
             raise ValueError(
                 "database must be a part of collecttableprefix if createdatabase flag is set"
             )
 
-    if args.drop_collecttable_flag:
+    if drop:
         logger.info(f"dropping table {tname}")
-        ch_client.command(f"DROP TABLE IF EXISTS {tname}")
+        ch_client.command(f"DROP TABLE IF EXISTS {tname}{on_cluster}")
+        if args.distributed_flag:
+            ch_client.command(f"DROP TABLE IF EXISTS {tname_local}{on_cluster}")
         logger.debug(f"table dropped")
 
-    logger.info(f"creating table {tname}")
+    local_tname = tname_local if args.distributed_flag else tname
+    logger.info(f"creating table {local_tname}")
     ch_client.command(
-        f"CREATE TABLE IF NOT EXISTS {tname} (objpath String, size Int64, last_modified DateTime, active Bool) ENGINE ReplacingMergeTree ORDER BY objpath PARTITION BY CRC32(objpath) % {args.samples}"
+        f"CREATE TABLE IF NOT EXISTS {local_tname}{on_cluster} (objpath String, size Int64, last_modified DateTime, active Bool) ENGINE ReplacingMergeTree ORDER BY objpath PARTITION BY {sample_hash}(objpath) % {args.samples}"
     )
+    if args.distributed_flag:
+        create_distributed_table(tname, tname_local, "objpath")
     logger.debug(f"table created")
+
+
+def create_distributed_table(distributed_tname, local_tname, column):
+    """Creates Distributed table over local_tname on the cluster sharded by CRC32(column)"""
+    database = quote_string(dbname.strip("`")) if dbname else "currentDatabase()"
+    table = quote_string(local_tname.split(".")[-1].strip("`"))
+    logger.info(f"creating table {distributed_tname}")
+    ch_client.command(
+        f"CREATE TABLE IF NOT EXISTS {distributed_tname}{on_cluster} AS {local_tname} ENGINE Distributed({quote_string(args.clustername)}, {database}, {table}, CRC32({column}))"
+    )
+
+
+def check_cluster():
+    """
+    Distributed table reads one replica per shard, and objects and references of a shard
+      may be on different replicas, so every object could look unused. Only one replica per shard is allowed.
+    """
+    result = ch_client.query(
+        f"SELECT count(), max(replica_num) FROM system.clusters WHERE cluster = {quote_string(args.clustername)}"
+    )
+    (num_hosts, max_replica_num) = result.result_rows[0]
+    if num_hosts == 0:
+        raise ValueError(f"cluster {args.clustername} is not found in system.clusters")
+    if max_replica_num > 1:
+        raise ValueError(
+            f"cluster {args.clustername} has shards with several replicas, distributed auxiliary table requires one replica per shard"
+        )
+
+
+def fill_refs_table():
+    """
+    Copies paths referenced on all replicas to refs_tname_local tables sharded like tname,
+      so every shard joins its part of objects with its part of references.
+    """
+    logger.info(f"creating table {refs_tname_local}")
+    ch_client.command(
+        f"CREATE TABLE IF NOT EXISTS {refs_tname_local}{on_cluster} (remote_path String) ENGINE MergeTree ORDER BY remote_path"
+    )
+    create_distributed_table(refs_tname, refs_tname_local, "remote_path")
+    ch_client.command(f"TRUNCATE TABLE IF EXISTS {refs_tname_local}{on_cluster}")
+
+    query = f"""
+        INSERT INTO {refs_tname} (remote_path)
+        SELECT remote_path FROM clusterAllReplicas({quote_string(args.clustername)}, system.remote_data_paths)
+        WHERE disk_name = {quote_string(args.s3diskname)}"""
+    if args.incremental_flag:
+        query += f" AND remote_path GLOBAL IN (SELECT objpath FROM {tname})"
+    logger.debug(query)
+    summary = ch_client.command(query)
+    num_inserted = int(summary.written_rows)
+    # all references must be on shards before antijoin
+    num_read = ch_client.command(f"SELECT count() FROM {refs_tname}")
+    if num_read < num_inserted:
+        raise ValueError(
+            f"{num_inserted} references inserted in {refs_tname}, {num_read} read back"
+        )
+    logger.info(f"{num_inserted} references are inserted in {refs_tname}")
+
+
+def do_collect(start_after=None, end_key=None):
+    """Collects objects after start_after up to end_key inclusive, returns number and total size of collected objects"""
+    logger.debug(f"start_after {start_after}, end_key {end_key}")
+    fast_list = args.fastlist_flag and fast_list_supported()
+    if args.fastlist_flag and not fast_list:
+        logger.warning("fast list is not supported by installed minio version, using list_objects")
+    if fast_list:
+        objects = list_objects_fast(args.s3bucket, args.s3path, start_after)
+    else:
+        objects = (
+            (obj.object_name, obj.size, obj.last_modified)
+            for obj in minio_client.list_objects(
+                args.s3bucket, args.s3path, recursive=True, start_after=start_after
+            )
+        )
+
     go_on = True
     rest_row_nums = args.total  # None if not set
     num_inserted = 0
     total_size = 0
+    age_limit = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(
+        hours=args.age
+    )
     while go_on:
         objs = []
         for batch_element in range(0, args.collectbatchsize):
             try:
-                obj = next(objects)
-                delta = datetime.datetime.now(datetime.timezone.utc) - obj.last_modified
-                hours = int(delta.seconds / 3600)
-                if hours >= args.age:
-                    objs.append([obj.object_name, obj.size, obj.last_modified, True])
-                    total_size += obj.size
+                (object_name, size, last_modified) = next(objects)
+                if end_key and object_name > end_key:
+                    objects.close()
+                    go_on = False
+                    break
+                if last_modified <= age_limit:
+                    objs.append([object_name, size, last_modified, True])
+                    total_size += size
             except StopIteration:
                 go_on = False
         ch_client.insert(tname, objs, column_names=["objpath", "size", "last_modified", "active"])
@@ -592,16 +980,109 @@ def do_collect():
     logger.info(
         f"information about {num_inserted} objects of total size {total_size} is inserted in {tname}"
     )
+    return (num_inserted, total_size)
+
+
+def create_watermark_table():
+    if args.createdatabase_flag and watermarkdbname:
+        logger.info(f"creating database {watermarkdbname}")
+        ch_client.command(f"CREATE DATABASE IF NOT EXISTS {watermarkdbname}")
+
+    logger.info(f"creating table {watermarktname}")
+    ch_client.command(
+        f"CREATE TABLE IF NOT EXISTS {watermarktname} (bucket String, s3path String, watermark DateTime64(6)) ENGINE ReplacingMergeTree(watermark) ORDER BY (bucket, s3path)"
+    )
+    logger.debug(f"table created")
+
+
+def do_collect_incremental():
+    """
+    Collects candidates from system.blob_storage_log events between stored watermark and now minus age:
+      objects uploaded and objects ClickHouse failed to delete.
+    Returns new watermark to be stored when candidates are processed.
+    """
+    create_watermark_table()
+    bucket_condition = f"bucket = {quote_string(args.s3bucket)} AND s3path = {quote_string(args.s3path)}"
+    result = ch_client.query(
+        f"SELECT toString(max(watermark)), count() FROM {watermarktname} FINAL WHERE {bucket_condition}"
+    )
+    (watermark, num_watermarks) = result.result_rows[0]
+    if num_watermarks == 0:
+        watermark = args.incrementalsince or "1970-01-01 00:00:00"
+    new_watermark = ch_client.command(
+        f"SELECT toString(now64(6) - INTERVAL {args.age} HOUR)"
+    )
+    logger.info(f"reading blob_storage_log from {watermark} to {new_watermark}")
+
+    blob_log = "system.blob_storage_log"
+    if args.clustername:
+        blob_log = f"clusterAllReplicas({quote_string(args.clustername)}, {blob_log})"
+
+    # the last event of an object in the window decides if it is a candidate
+    last_event = "argMax(event_type, event_time_microseconds)"
+    last_error = "argMax(error, event_time_microseconds)"
+    query = f"""
+        INSERT INTO {tname} (objpath, size, last_modified, active)
+        SELECT remote_path, max(data_size), max(event_time), true FROM {blob_log}
+        WHERE disk_name = {quote_string(args.s3diskname)} AND bucket = {quote_string(args.s3bucket)}
+          AND startsWith(remote_path, {quote_string(args.s3path)})
+          AND event_date >= toDate(toDateTime64({quote_string(watermark)}, 6))
+          AND event_time_microseconds > toDateTime64({quote_string(watermark)}, 6)
+          AND event_time_microseconds <= toDateTime64({quote_string(new_watermark)}, 6)
+        GROUP BY remote_path
+        HAVING ({last_event} IN ('Upload', 'MultiPartUploadComplete') AND {last_error} = '')
+          OR ({last_event} = 'Delete' AND {last_error} != '')"""
+    logger.debug(query)
+    ch_client.command(query)
+    logger.info(f"candidates from {blob_log} are inserted in {tname}")
+    return new_watermark
+
+
+def store_watermark(watermark):
+    logger.info(f"storing watermark {watermark} in {watermarktname}")
+    ch_client.command(
+        f"INSERT INTO {watermarktname} (bucket, s3path, watermark) SELECT {quote_string(args.s3bucket)}, {quote_string(args.s3path)}, toDateTime64({quote_string(watermark)}, 6)"
+    )
 
 
-def do_use():
+def do_use(start_after=None, end_key=None):
+    """
+    Removes unused objects after start_after up to end_key inclusive,
+      returns number and total size of removed objects and number of errors on removing
+    """
     srdp = "system.remote_data_paths"
     if args.clustername:
         srdp = f"clusterAllReplicas('{args.clustername}', {srdp})"
+    srdp_condition = f"rdp.remote_path = s3o.objpath AND rdp.disk_name='{args.s3diskname}'"
+
+    # a worker joins only paths of its range instead of all referenced paths
+    srdp_filters = []
+    if start_after:
+        srdp_filters.append(f"remote_path > {quote_string(start_after)}")
+    if end_key:
+        srdp_filters.append(f"remote_path <= {quote_string(end_key)}")
+    # few incremental candidates are checked against referenced paths filtered by them
+    if args.incremental_flag:
+        srdp_filters.append(f"remote_path GLOBAL IN (SELECT objpath FROM {tname})")
+    if srdp_filters:
+        srdp = f"(SELECT remote_path, disk_name FROM {srdp} WHERE {' AND '.join(srdp_filters)})"
+
+    if args.distributed_flag:
+        # the local table on each shard, right side of JOIN is not sent to shards
+        srdp = refs_tname_local
+        srdp_condition = "rdp.remote_path = s3o.objpath"
+
+    range_condition = ""
+    if start_after:
+        range_condition += f"AND s3o.objpath > {quote_string(start_after)} "
+    if end_key:
+        range_condition += f"AND s3o.objpath <= {quote_string(end_key)} "
 
     num_rows = 0
     try:
         count_query = f"SELECT COUNT(1) FROM {tname}"
+        if range_condition:
+            count_query += f" AS s3o WHERE true {range_condition}"
         logger.debug(count_query)
         result = ch_client.command(count_query)
         num_rows = result
@@ -610,8 +1091,14 @@ def do_use():
         pass
     if num_rows == 0:
         logger.info(f"auxiliary table {tname} does not exist or empty, nothing to do")
+        return (0, 0, 0)
 
-        graceful_exit()
+    if args.distributed_flag:
+        fill_refs_table()
+
+    # incremental candidates are few, and a worker range already partitions the keyspace,
+    #   one pass is enough; every pass reads remote_data_paths again
+    samples = 1 if args.incremental_flag or args.worker_flag else args.samples
 
     def make_antijoin(calc_only=False, sample=None):
         after_condition = f"AND s3o.objpath > {args.useafter} " if args.useafter else ""
@@ -619,13 +1106,13 @@ def do_use():
         limit = f" LIMIT {args.usetotal} " if args.usetotal else ""
 
         sample_condition = " "
-        if not calc_only:
-            sample_condition = f"CRC32(s3o.objpath) % {args.samples} = {sample} AND "
+        if not calc_only and samples > 1:
+            sample_condition = f"{sample_hash}(s3o.objpath) % {args.samples} = {sample} AND "
 
         antijoin = f"""
         SELECT s3o.objpath, s3o.size as size, s3o.last_modified as last_modified FROM {tname} AS s3o LEFT ANTI JOIN {srdp} AS rdp ON
-        (rdp.remote_path = s3o.objpath AND rdp.disk_name='{args.s3diskname}')
-        WHERE {sample_condition} s3o.active=true {after_condition} {age_condition}
+        ({srdp_condition})
+        WHERE {sample_condition} s3o.active=true {after_condition} {age_condition} {range_condition}
         ORDER BY s3o.objpath {limit} SETTINGS final = 1"""
 
         if calc_only:
@@ -647,7 +1134,7 @@ def do_use():
         num_rows, total_size = result.result_rows[0]
         if num_rows == 0:
             logger.info("Nothing to do")
-            graceful_exit()
+            return (0, 0, 0)
 
         while True:
             answer = input(
@@ -661,10 +1148,11 @@ def do_use():
                 pass
 
     num_removed = 0
+    num_errors = 0
     total_size = 0
     objs = []
 
-    for sample in range(0, args.samples):
+    for sample in range(0, samples):
         antijoin = make_antijoin(sample=sample)
         logger.info(f"antijoin {antijoin}")
 
@@ -688,7 +1176,8 @@ def do_use():
                             args.s3bucket, objects_to_remove
                         )
                         for error in errors:
-                            logger.info(f"error occurred when deleting object via remove_objects {error}")
+                            num_errors += 1
+                            logger.warning(f"error occurred when deleting object via remove_objects {error}")
                     else:
                         for object_path in object_to_remove:
                             try:
@@ -696,9 +1185,10 @@ def do_use():
                                     args.s3bucket, object_path
                                 )
                             except Exception as error:
-                                logger.info(f"error occurred when deleting object {object_path} via remove_object {error}")
+                                num_errors += 1
+                                logger.warning(f"error occurred when deleting object {object_path} via remove_object {error}")
 
-                num_removed += len(objects_to_remove)
+                num_removed += len(objects_to_remove) + len(object_to_remove)
 
         if not args.dryrun_flag:
             ch_client.insert(tname, objs, column_names=["objpath", "size", "last_modified", "active"])
@@ -707,19 +1197,211 @@ def do_use():
         f"{num_removed} objects of total size {total_size} {'are removed' if not args.dryrun_flag else 'would be removed but for dryrun flag'}"
     )
 
-    if not args.keepdata_flag and not args.dryrun_flag:
+    # other workers are still using auxiliary table, it is truncated by --work-init
+    if not args.keepdata_flag and not args.dryrun_flag and not args.worker_flag:
+        logger.info(f"truncating {tname}")
+        if args.distributed_flag:
+            ch_client.command(f"TRUNCATE TABLE {tname_local}{on_cluster}")
+        else:
+            ch_client.command(f"TRUNCATE TABLE {tname}")
+    if args.distributed_flag:
+        ch_client.command(f"TRUNCATE TABLE {refs_tname_local}{on_cluster}")
+
+    return (num_removed, total_size, num_errors)
+
+
+##############################################################
+# Workers coordinated through work table.
+# Keyspace is split into ranges (start_after, end_key], empty end_key means no upper bound.
+# The latest row (by version) for a range_id is its current state; claims, lease renewals
+#   and results are inserted as new rows, versions are taken from ClickHouse server clock.
+# Two workers may occasionally process the same range, it is harmless since
+#   collecting and removing are idempotent.
+
+
+def create_work_table():
+    if args.createdatabase_flag and workdbname:
+        logger.info(f"creating database {workdbname}")
+        ch_client.command(f"CREATE DATABASE IF NOT EXISTS {workdbname}")
+
+    logger.info(f"creating table {worktname}")
+    ch_client.command(
+        f"CREATE TABLE IF NOT EXISTS {worktname} (range_id UInt32, start_after String, end_key String, state Enum8('pending' = 0, 'claimed' = 1, 'done' = 2), worker String, lease_until DateTime, num_collected UInt64, num_removed UInt64, removed_size Int64, version UInt64) ENGINE ReplacingMergeTree(version) ORDER BY range_id"
+    )
+    logger.debug(f"table created")
+
+
+def update_range(state, condition, lease=True, results="num_collected, num_removed, removed_size", client=None):
+    """Inserts new state of ranges matching condition, lease is prolonged unless lease is False"""
+    lease_until = f"now() + {args.leaseseconds}" if lease else "lease_until"
+    query = f"""
+        INSERT INTO {worktname} (range_id, start_after, end_key, state, worker, lease_until, num_collected, num_removed, removed_size, version)
+        SELECT range_id, start_after, end_key, '{state}', {quote_string(worker_id)}, {lease_until}, {results}, toUnixTimestamp64Nano(now64(9))
+        FROM {worktname} FINAL WHERE {condition}"""
+    logger.debug(query)
+    (client or ch_client).command(query)
+
+
+def claim_range():
+    """Returns (range_id, start_after, end_key) claimed by this worker or None if all ranges are done"""
+    global current_lease
+    claimable = "state = 'pending' OR (state = 'claimed' AND lease_until < now())"
+    while True:
+        update_range("claimed", f"{claimable} ORDER BY rand() LIMIT 1")
+        result = ch_client.query(
+            f"SELECT range_id, start_after, end_key FROM {worktname} FINAL WHERE state = 'claimed' AND worker = {quote_string(worker_id)} LIMIT 1"
+        )
+        if result.result_rows:
+            stop = threading.Event()
+            heartbeat = threading.Thread(
+                target=lease_heartbeat, args=(result.result_rows[0][0], stop), daemon=True
+            )
+            heartbeat.start()
+            current_lease = {"stop": stop, "heartbeat": heartbeat}
+            return result.result_rows[0]
+
+        result = ch_client.query(
+            f"SELECT countIf(state != 'done'), countIf({claimable}) FROM {worktname} FINAL"
+        )
+        (unfinished, available) = result.result_rows[0]
+        if unfinished == 0:
+            return None
+        if available == 0:
+            # wait for other workers to finish or for their leases to expire
+            logger.debug(f"{unfinished} ranges are claimed by other workers, waiting")
+            time.sleep(max(1, min(args.leaseseconds // 4, 30)))
+
+
+def lease_heartbeat(range_id, stop):
+    """
+    Prolongs lease of range_id until stop is set.
+    Runs in its own thread with its own ClickHouse client, so long antijoins do not delay it.
+    """
+    client = make_ch_client()
+    try:
+        while not stop.wait(args.leaseseconds / 3):
+            logger.debug(f"renewing lease for range {range_id}")
+            try:
+                update_range(
+                    "claimed",
+                    f"range_id = {range_id} AND state = 'claimed' AND worker = {quote_string(worker_id)}",
+                    client=client,
+                )
+            except Exception as exc:
+                logger.warning(f"failed to renew lease for range {range_id}, {exc}")
+    finally:
+        client.close()
+
+
+def finish_range(range_id, num_collected, num_removed, removed_size):
+    global current_lease
+    current_lease["stop"].set()
+    current_lease["heartbeat"].join()
+    update_range(
+        "done",
+        f"range_id = {range_id}",
+        lease=False,
+        results=f"{num_collected}, {num_removed}, {removed_size}",
+    )
+    current_lease = None
+
+
+def do_work_init():
+    create_work_table()
+    create_collect_table(drop=args.drop_collecttable_flag)
+    if not args.keepdata_flag:
         logger.info(f"truncating {tname}")
         ch_client.command(f"TRUNCATE TABLE {tname}")
 
+    prefixes = [
+        obj.object_name
+        for obj in minio_client.list_objects(
+            args.s3bucket, args.s3path, start_after=args.collectafter
+        )
+        if obj.is_dir
+    ]
+    num_ranges = max(1, min(args.workranges, len(prefixes)))
+    bounds = (
+        [args.collectafter or ""]
+        + [prefixes[len(prefixes) * i // num_ranges] for i in range(1, num_ranges)]
+        + [""]
+    )
+    ranges = [
+        [i, bounds[i], bounds[i + 1], "pending", "", datetime.datetime.fromtimestamp(0, datetime.timezone.utc), 0, 0, 0, 0]
+        for i in range(0, num_ranges)
+    ]
+
+    logger.info(f"truncating {worktname}")
+    ch_client.command(f"TRUNCATE TABLE {worktname}")
+    ch_client.insert(
+        worktname,
+        ranges,
+        column_names=["range_id", "start_after", "end_key", "state", "worker", "lease_until", "num_collected", "num_removed", "removed_size", "version"],
+    )
+    logger.info(f"{num_ranges} ranges are inserted in {worktname}")
+
+
+def do_work():
+    create_collect_table()
+    while True:
+        work_range = claim_range()
+        if work_range is None:
+            break
+        (range_id, start_after, end_key) = work_range
+        logger.info(f"worker {worker_id} claimed range {range_id} ({start_after}, {end_key}]")
+
+        num_collected = 0
+        if not args.usecollected_flag:
+            (num_collected, _) = do_collect(start_after, end_key)
+        (num_removed, removed_size) = (0, 0)
+        if not args.collectonly_flag:
+            (num_removed, removed_size, _) = do_use(start_after, end_key)
+        finish_range(range_id, num_collected, num_removed, removed_size)
+
+    do_work_summary()
+
+
+def do_work_summary():
+    result = ch_client.query(
+        f"SELECT countIf(state = 'pending'), countIf(state = 'claimed'), countIf(state = 'done'), sum(num_collected), sum(num_removed), sum(removed_size) FROM {worktname} FINAL"
+    )
+    (pending, claimed, done, num_collected, num_removed, removed_size) = result.result_rows[0]
+    if not args.silent_flag:
+        print(
+            f"s3gc: ranges pending {pending}, claimed {claimed}, done {done}; {num_collected} objects collected, {num_removed} objects of total size {removed_size} removed{' (dryrun)' if args.dryrun_flag else ''}"
+        )
+
 
 def main():
     connect_to_ch()
-    if not (args.usecollected_flag and args.dryrun_flag):
+    if args.distributed_flag:
+        check_cluster()
+    if args.worksummary_flag:
+        do_work_summary()
+        graceful_exit()
+    if args.workinit_flag or not (args.usecollected_flag and args.dryrun_flag):
         connect_to_s3()
-    if not args.usecollected_flag:
-        do_collect()
-    if not args.collectonly_flag:
-        do_use()
+    if args.workinit_flag:
+        do_work_init()
+    elif args.worker_flag:
+        do_work()
+    else:
+        watermark = None
+        num_errors = 0
+        if not args.usecollected_flag:
+            create_collect_table(drop=args.drop_collecttable_flag)
+            if args.incremental_flag:
+                watermark = do_collect_incremental()
+            else:
+                do_collect(args.collectafter)
+        if not args.collectonly_flag:
+            (_, _, num_errors) = do_use()
+        if watermark and not args.dryrun_flag:
+            if num_errors:
+                # objects failed to be removed are candidates again in the next run
+                logger.warning(f"{num_errors} objects are not removed, watermark is not stored")
+            else:
+                store_watermark(watermark)
 
     graceful_exit()
 